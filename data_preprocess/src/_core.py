@@ -0,0 +1,484 @@
+"""
+数据预处理公共逻辑
+
+server.py、server_with_logging.py 和 data_preprocess.py 共用的配置、提示词模板、
+分类信息缓存、DeepSeek调用以及备用的关键词匹配方案
+"""
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
+import orjson
+import os
+import re
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator, List
+from mcp.server.fastmcp import Context
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# 硅基流动 API 配置
+SILICONFLOW_CONFIG = {
+    "api_url": "https://api.siliconflow.cn/v1/chat/completions",
+    "model": "deepseek-ai/DeepSeek-V3",
+    "max_tokens": 2000,
+    "timeout": 60
+}
+
+# 订单分类API配置
+CATEGORY_API_URL = "https://1m9r5sk109.execute-api.cn-northwest-1.amazonaws.com.cn/prod/category"
+# 分类信息缓存时间（秒），分类很少变化，无需每次请求都重新获取
+CATEGORY_CACHE_TTL = 300
+
+# 分类信息进程内缓存：原始数据、序列化后的JSON字符串及据此生成的系统提示词
+_CATEGORIES_CACHE: Dict[str, Any] = {"ts": 0.0, "data": None, "json": None, "system_prompt": None}
+
+# 任务提取结果磁盘缓存配置：相同查询+相同意图库直接复用上次LLM的提取结果
+TASK_CACHE_DIR = "/tmp/data_preprocess_cache"
+TASK_CACHE_SIZE_LIMIT = 100 * 1024 * 1024
+TASK_CACHE_EXPIRE = 3600
+
+_TASK_CACHE = diskcache.Cache(TASK_CACHE_DIR, size_limit=TASK_CACHE_SIZE_LIMIT)
+
+# 订单号模式（合并为一个预编译的正则，只需扫描一遍查询）
+_ORDER_RE = re.compile(
+    r'订单号?\s*[：:]\s*([A-Za-z0-9]+)'
+    r'|订单\s*([A-Za-z0-9]+)'
+    r'|([A-Za-z0-9]{10,})'  # 假设订单号至少10位
+)
+
+# 意图关键词，按意图识别的优先顺序排列
+_INTENT_KEYWORDS = (
+    ('查询订单状态', ('查询', '查看', '状态')),
+    ('取消订单', ('取消', '退订')),
+    ('修改订单', ('修改', '更改')),
+)
+_INTENT_BY_KEYWORD = {word: purpose for purpose, keywords in _INTENT_KEYWORDS for word in keywords}
+# 所有意图关键词合并为一个正则，一次线性扫描即可找出全部命中的关键词
+_INTENT_RE = re.compile('|'.join(map(re.escape, _INTENT_BY_KEYWORD)))
+
+# markdown代码块标记，一次匹配即可取出其中的JSON内容
+_FENCE_RE = re.compile(r'^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$', re.S)
+
+# 系统提示词模板，{categories}处填入意图库
+SYSTEM_PROMPT_TEMPLATE = """你是一个订单查询分析助手。你需要从用户的查询问题中提取订单相关任务，并将其分解为标准格式。
+
+你需要遵循以下规则：
+1. 意图库是categories in {categories}
+2. 每个task必须包含订单号(order_id)和具体意图(purpose)
+3. 判断是否为有效问题(valid_question)：查询内容必须与意图库中的操作相关
+4. 判断是否为多任务(multi-task)：包含多个订单号或多个意图时为true
+5. 统计任务数量(task_count)：提取出的合法task数量
+6. 按照固定格式输出结果，必须是有效的JSON格式
+
+输出格式示例：
+单任务：
+{{
+    "valid_question": "yes",
+    "multi-task": "no",
+    "task_count": 1,
+    "tasks": {{
+        "order_id_1": "xxx",
+        "purpose_1": "xxx"
+    }}
+}}
+
+多任务：
+{{
+    "valid_question": "yes",
+    "multi-task": "yes",
+    "task_count": 2,
+    "task_1": {{
+        "order_id_1": "xxx",
+        "purpose_1": "xxx"
+    }},
+    "task_2": {{
+        "order_id_2": "xxx",
+        "purpose_2": "xxx"
+    }}
+}}
+
+无效问题：
+{{
+    "valid_question": "no"
+}}"""
+
+# 用户提示词模板
+USER_PROMPT_TEMPLATE = """请分析以下查询问题，提取订单任务信息：
+
+{input_query}
+
+请按照以下步骤进行分析，只输出最终的JSON结果：
+
+1. 判断是否为有效的订单相关问题
+2. 识别问题中的订单号和操作意图
+3. 确认是否存在多任务情况
+4. 统计任务数量
+5. 按照规定格式输出结果"""
+
+# 批量查询的用户提示词模板
+BATCH_USER_PROMPT_TEMPLATE = """请分别分析以下{count}个查询问题，提取每个查询的订单任务信息：
+
+{queries}
+
+请对每个查询按照以下步骤进行分析，只输出最终的JSON结果：
+
+1. 判断是否为有效的订单相关问题
+2. 识别问题中的订单号和操作意图
+3. 确认是否存在多任务情况
+4. 统计任务数量
+5. 按照规定格式输出结果
+
+输出必须是一个JSON数组，数组中第i个元素为第i个查询的结果，共{count}个元素"""
+
+# 共享异步HTTP客户端：复用keep-alive连接，且等待网络时不阻塞MCP服务器的事件循环
+_CLIENT = httpx.AsyncClient(
+    timeout=SILICONFLOW_CONFIG["timeout"],
+    headers={"Content-Type": "application/json"},
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+    )
+)
+
+@asynccontextmanager
+async def close_client_lifespan(server: Any) -> AsyncIterator[None]:
+    """FastMCP服务器的lifespan：服务器退出时关闭共享HTTP客户端"""
+    try:
+        yield
+    finally:
+        await _CLIENT.aclose()
+
+def get_local_tz(local_tz_override: str | None = None) -> ZoneInfo:
+    # Get local timezone from datetime.now()
+    tzinfo = datetime.now().astimezone(tz=None).tzinfo
+    if tzinfo is not None:
+        tz_str = str(tzinfo)
+        if tz_str == "CST":
+            tz_str = "America/Chicago"
+        return ZoneInfo(tz_str)
+    else:
+        raise ValueError('get local timezone failed')
+
+@functools.cache
+def _local_tz_str() -> str:
+    """本地时区在进程内不会变化，只需计算一次"""
+    return str(get_local_tz())
+
+def update_docstring_with_info(func):
+    """更新函数的docstring"""
+    if func.__doc__:
+        func.__doc__ = func.__doc__.format(local_tz=_local_tz_str())
+    return func
+
+def get_cached_categories() -> Optional[Dict[str, Any]]:
+    """返回仍在有效期内的缓存分类信息，没有则返回None"""
+    if _CATEGORIES_CACHE["data"] is not None and time.monotonic() - _CATEGORIES_CACHE["ts"] < CATEGORY_CACHE_TTL:
+        return _CATEGORIES_CACHE["data"]
+    return None
+
+def cache_categories(categories: Dict[str, Any]) -> None:
+    """缓存分类信息，同时预先生成其JSON字符串和系统提示词"""
+    categories_json = orjson.dumps(categories).decode()
+    _CATEGORIES_CACHE.update(
+        ts=time.monotonic(),
+        data=categories,
+        json=categories_json,
+        system_prompt=SYSTEM_PROMPT_TEMPLATE.format(categories=categories_json)
+    )
+
+async def get_categories() -> Optional[Dict[str, Any]]:
+    """获取订单分类信息（带进程内TTL缓存）"""
+    categories = get_cached_categories()
+    if categories is not None:
+        logger.info("命中订单分类信息缓存")
+        return categories
+
+    logger.info("开始获取订单分类信息")
+    try:
+        response = await _CLIENT.get(CATEGORY_API_URL, timeout=30)
+        response.raise_for_status()
+        logger.info("成功获取订单分类信息")
+        categories = orjson.loads(response.content)
+    except httpx.HTTPError as e:
+        logger.error("HTTP请求失败: %s", e)
+        return None
+
+    cache_categories(categories)
+    return categories
+
+def get_categories_json(categories: Dict[str, Any]) -> str:
+    """获取分类信息的JSON字符串，命中缓存时直接复用已序列化的结果"""
+    if categories is _CATEGORIES_CACHE["data"]:
+        return _CATEGORIES_CACHE["json"]
+    return orjson.dumps(categories).decode()
+
+class JsonCompletionTracker:
+    """增量跟踪流式输出中的JSON，最外层对象/数组闭合时即可停止接收"""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> bool:
+        """输入新到达的文本片段，返回最外层JSON是否已经闭合"""
+        for ch in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.started
+            elif ch in '{[':
+                self.depth += 1
+                self.started = True
+            elif ch in '}]' and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+# API密钥在导入时读取一次，请求头随之构建好并在每次调用中复用；
+# 未设置时不在导入阶段报错，以免影响不需要调用API的备用逻辑
+_API_KEY = os.getenv('SILICONFLOW_API_KEY')
+_HEADERS = {"Authorization": f"Bearer {_API_KEY}"} if _API_KEY else None
+
+def build_deepseek_headers() -> Dict[str, str]:
+    """返回DeepSeek API请求头（Content-Type由HTTP会话统一设置）"""
+    if _HEADERS is None:
+        logger.error("未设置环境变量 SILICONFLOW_API_KEY")
+        raise ValueError("请设置环境变量 SILICONFLOW_API_KEY")
+    return _HEADERS
+
+# 请求体中每次调用都不变的部分
+_PAYLOAD_STATIC = {
+    "model": SILICONFLOW_CONFIG["model"],
+    "max_tokens": SILICONFLOW_CONFIG["max_tokens"],
+    "stream": True
+}
+
+def build_deepseek_payload(messages: list, temperature: float) -> bytes:
+    """构建DeepSeek API流式请求体，直接用orjson序列化为bytes，不再经过HTTP库内部的标准库json"""
+    return orjson.dumps({**_PAYLOAD_STATIC, "messages": messages, "temperature": temperature})
+
+def parse_sse_line(line: str) -> Optional[str]:
+    """解析一行SSE流式响应，返回本行新增的内容；收到结束标记时返回None"""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    choices = orjson.loads(data).get('choices')
+    if not choices:
+        return ""
+    return choices[0]['delta'].get('content') or ""
+
+async def call_siliconflow_deepseek(messages: list, temperature: float = 0.7, ctx: Optional[Context] = None) -> Optional[str]:
+    """调用硅基流动 DeepSeek API（流式接收，JSON结果完整后提前结束）"""
+    logger.info("开始调用硅基流动 DeepSeek API")
+    headers = build_deepseek_headers()
+    payload = build_deepseek_payload(messages, temperature)
+
+    try:
+        logger.info("发送请求到 %s", SILICONFLOW_CONFIG['api_url'])
+        content_parts = []
+        tracker = JsonCompletionTracker()
+        async with _CLIENT.stream(
+            "POST",
+            SILICONFLOW_CONFIG["api_url"],
+            headers=headers,
+            content=payload,
+            timeout=SILICONFLOW_CONFIG["timeout"]
+        ) as response:
+            response.raise_for_status()
+            # 只在几个阶段节点上报进度（请求已受理、收到首个内容、结果完整），避免每个增量都发一次通知
+            if ctx is not None:
+                await ctx.report_progress(1, 3)
+            async for line in response.aiter_lines():
+                delta = parse_sse_line(line)
+                if delta is None:
+                    break
+                if not delta:
+                    continue
+                if ctx is not None and not content_parts:
+                    await ctx.report_progress(2, 3)
+                content_parts.append(delta)
+                # 最外层JSON已经闭合，无需等待模型输出剩余内容
+                if tracker.feed(delta):
+                    break
+        if ctx is not None:
+            await ctx.report_progress(3, 3)
+        logger.info("成功获取 DeepSeek API 响应")
+        return "".join(content_parts)
+    except httpx.HTTPError as e:
+        logger.error("DeepSeek API调用失败: %s", e)
+        return None
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+        logger.error("解析API响应失败: %s", e)
+        return None
+
+def has_order_intent(input_query: str) -> bool:
+    """本地快速判断查询是否可能涉及订单操作：既没有订单号也没有意图关键词时返回False"""
+    return bool(_ORDER_RE.search(input_query) or _INTENT_RE.search(input_query))
+
+def simulate_llm_response(input_query: str) -> Dict[str, Any]:
+    """模拟LLM响应（备用方案）"""
+    logger.info("使用模拟LLM响应处理查询: %s", input_query)
+
+    # 查找订单号（每个匹配只有一个分组非空），按出现顺序去重，保证与意图按下标对齐
+    order_ids = list(dict.fromkeys(m for groups in _ORDER_RE.findall(input_query) for m in groups if m))
+    logger.info("提取到的订单号: %s", order_ids)
+
+    if not order_ids:
+        logger.info("未找到有效订单号，返回无效问题")
+        return {"valid_question": "no"}
+
+    # 简单的意图识别
+    matched = {_INTENT_BY_KEYWORD[word] for word in _INTENT_RE.findall(input_query)}
+    purposes = [purpose for purpose, _ in _INTENT_KEYWORDS if purpose in matched]
+
+    if not purposes:
+        purposes = ['查询订单状态']  # 默认意图
+
+    logger.info("识别到的意图: %s", purposes)
+
+    task_count = max(len(order_ids), len(purposes))
+
+    if task_count == 1:
+        result = {
+            "valid_question": "yes",
+            "multi-task": "no",
+            "task_count": 1,
+            "tasks": {
+                "order_id_1": order_ids[0] if order_ids else "unknown",
+                "purpose_1": purposes[0]
+            }
+        }
+    else:
+        result = {
+            "valid_question": "yes",
+            "multi-task": "yes",
+            "task_count": task_count
+        }
+
+        for i in range(task_count):
+            task_key = f"task_{i+1}"
+            result[task_key] = {
+                f"order_id_{i+1}": order_ids[i] if i < len(order_ids) else order_ids[-1],
+                f"purpose_{i+1}": purposes[i] if i < len(purposes) else purposes[-1]
+            }
+
+    logger.info("模拟响应结果: %s", result)
+    return result
+
+def build_system_prompt(categories: Dict[str, Any]) -> str:
+    """构建包含意图库的系统提示词"""
+    if categories is _CATEGORIES_CACHE["data"]:
+        return _CATEGORIES_CACHE["system_prompt"]
+    return SYSTEM_PROMPT_TEMPLATE.format(categories=get_categories_json(categories))
+
+def strip_markdown_fence(content: str) -> str:
+    """清理响应内容，移除可能的markdown格式（流式提前结束时可能没有结尾的```）"""
+    return _FENCE_RE.match(content).group(1)
+
+def build_task_messages(input_query: str, categories: Dict[str, Any]) -> List[Dict[str, str]]:
+    """构建单个查询的任务提取消息"""
+    return [
+        {"role": "system", "content": build_system_prompt(categories)},
+        {"role": "user", "content": USER_PROMPT_TEMPLATE.format(input_query=input_query)}
+    ]
+
+def _task_cache_key(input_query: str, categories: Dict[str, Any]) -> bytes:
+    """任务提取结果的缓存键，意图库变化后旧结果自动失效"""
+    return hashlib.blake2b(
+        f"{input_query}|{get_categories_json(categories)}".encode(),
+        digest_size=16
+    ).digest()
+
+def get_cached_task_summary(input_query: str, categories: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """返回磁盘缓存中相同查询的任务提取结果，没有则返回None"""
+    result = _TASK_CACHE.get(_task_cache_key(input_query, categories))
+    if result is not None:
+        logger.info("命中任务提取结果缓存，查询: %s", input_query)
+    return result
+
+def parse_task_response(response_content: Optional[str], input_query: str, categories: Dict[str, Any]) -> Dict[str, Any]:
+    """解析单个查询的LLM响应，调用或解析失败时使用备用方案（备用方案的结果不缓存）"""
+    if not response_content:
+        logger.warning("DeepSeek API调用失败，使用备用方案")
+        return simulate_llm_response(input_query)
+
+    try:
+        # 尝试解析JSON响应
+        result = orjson.loads(strip_markdown_fence(response_content))
+        logger.info("成功解析DeepSeek响应: %s", result)
+        _TASK_CACHE.set(_task_cache_key(input_query, categories), result, expire=TASK_CACHE_EXPIRE)
+        return result
+
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON解析失败: %s", e)
+        logger.error("原始响应: %s", response_content)
+        # 如果解析失败，使用备用方案
+        return simulate_llm_response(input_query)
+
+def build_batch_messages(queries: List[str], categories: Dict[str, Any]) -> List[Dict[str, str]]:
+    """构建批量查询的任务提取消息，意图库只在系统提示词中出现一次"""
+    user_prompt = BATCH_USER_PROMPT_TEMPLATE.format(
+        count=len(queries),
+        queries="\n".join(f"{i}) {query}" for i, query in enumerate(queries, 1))
+    )
+    return [
+        {"role": "system", "content": build_system_prompt(categories)},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def parse_batch_response(response_content: Optional[str], queries: List[str]) -> List[Dict[str, Any]]:
+    """解析批量查询的LLM响应，调用或解析失败时对每个查询使用备用方案"""
+    if not response_content:
+        logger.warning("DeepSeek API批量调用失败，使用备用方案")
+        return [simulate_llm_response(query) for query in queries]
+
+    try:
+        results = orjson.loads(strip_markdown_fence(response_content))
+    except orjson.JSONDecodeError as e:
+        logger.error("批量JSON解析失败: %s", e)
+        return [simulate_llm_response(query) for query in queries]
+
+    if not isinstance(results, list) or len(results) != len(queries):
+        logger.error("批量响应数量与查询数量不一致: %s", response_content)
+        return [simulate_llm_response(query) for query in queries]
+
+    return results
+
+async def extract_tasks_with_deepseek(input_query: str, categories: Dict[str, Any], ctx: Optional[Context] = None) -> Dict[str, Any]:
+    """使用DeepSeek API从用户查询中提取订单任务信息"""
+    # diskcache读写是同步的SQLite磁盘I/O，放到线程中执行，避免阻塞事件循环
+    cached = await asyncio.to_thread(get_cached_task_summary, input_query, categories)
+    if cached is not None:
+        return cached
+
+    logger.info("使用DeepSeek提取任务信息，查询: %s", input_query)
+
+    messages = build_task_messages(input_query, categories)
+    response_content = await call_siliconflow_deepseek(messages, temperature=0.7, ctx=ctx)
+    return await asyncio.to_thread(parse_task_response, response_content, input_query, categories)
+
+async def extract_tasks_batch(queries: List[str], categories: Dict[str, Any], ctx: Optional[Context] = None) -> List[Dict[str, Any]]:
+    """在一次DeepSeek API调用中批量提取多个查询的订单任务信息"""
+    if not queries:
+        return []
+    logger.info("使用DeepSeek批量提取任务信息，查询数量: %s", len(queries))
+
+    messages = build_batch_messages(queries, categories)
+    response_content = await call_siliconflow_deepseek(messages, temperature=0.7, ctx=ctx)
+    return parse_batch_response(response_content, queries)
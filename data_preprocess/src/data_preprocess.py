@@ -1,18 +1,36 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from typing import Dict, Any, Optional
+import orjson
+from typing import Dict, Any, List, Optional
 import os
 
-# 硅基流动 API 配置
-SILICONFLOW_CONFIG = {
-    "api_url": "https://api.siliconflow.cn/v1/chat/completions",
-    "model": "deepseek-ai/DeepSeek-V3",
-    "max_tokens": 2000,
-    "timeout": 60
-}
-
-# 订单分类API配置
-CATEGORY_API_URL = "https://1m9r5sk109.execute-api.cn-northwest-1.amazonaws.com.cn/prod/category"
+from _core import (
+    SILICONFLOW_CONFIG,
+    CATEGORY_API_URL,
+    JsonCompletionTracker,
+    has_order_intent,
+    get_cached_categories,
+    cache_categories,
+    build_deepseek_headers,
+    build_deepseek_payload,
+    parse_sse_line,
+    get_cached_task_summary,
+    build_task_messages,
+    parse_task_response,
+    build_batch_messages,
+    parse_batch_response,
+)
+
+# 共享HTTP会话：复用keep-alive连接，避免每次请求重新进行TCP+TLS握手
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
 
 # 从环境变量获取API密钥
 def get_api_key():
@@ -23,60 +41,21 @@ def get_api_key():
         print("请运行: export SILICONFLOW_API_KEY='your_api_key_here'")
     return api_key
 
-# 默认提示词模板
-SYSTEM_PROMPT_TEMPLATE = """你是一个订单查询分析助手。你需要从用户的查询问题中提取订单相关任务，并将其分解为标准格式。
-
-你需要遵循以下规则：
-1. 意图库是categories in {categories}
-2. 每个task必须包含订单号(order_id)和具体意图(purpose)
-3. 判断是否为有效问题(valid_question)：查询内容必须与意图库中的操作相关
-4. 判断是否为多任务(multi-task)：包含多个订单号或多个意图时为true
-5. 统计任务数量(task_count)：提取出的合法task数量
-6. 按照固定格式输出结果，必须是有效的JSON格式
-
-输出格式示例：
-单任务：
-{{
-    "valid_question": "yes",
-    "multi-task": "no",
-    "task_count": 1,
-    "tasks": {{
-        "order_id_1": "xxx",
-        "purpose_1": "xxx"
-    }}
-}}
-
-多任务：
-{{
-    "valid_question": "yes",
-    "multi-task": "yes",
-    "task_count": 2,
-    "task_1": {{
-        "order_id_1": "xxx",
-        "purpose_1": "xxx"
-    }},
-    "task_2": {{
-        "order_id_2": "xxx",
-        "purpose_2": "xxx"
-    }}
-}}
-
-无效问题：
-{{
-    "valid_question": "no"
-}}"""
-
 def data_preprocess(input_query: str) -> Dict[str, Any]:
     """
     数据预处理函数，基于data_preprocess.yml工作流
-    
+
     Args:
         input_query (str): 用户输入的查询问题
-        
+
     Returns:
         Dict[str, Any]: 处理后的任务摘要
     """
-    
+
+    # 明显与订单无关的查询直接判为无效，不再请求分类接口和DeepSeek
+    if not has_order_intent(input_query):
+        return {"valid_question": "no"}
+
     # Step 1: HTTP Request - 获取分类信息
     try:
         categories_response = get_categories()
@@ -84,7 +63,7 @@ def data_preprocess(input_query: str) -> Dict[str, Any]:
             return {"error": "Failed to fetch categories"}
     except Exception as e:
         return {"error": f"HTTP request failed: {str(e)}"}
-    
+
     # Step 2: LLM Processing - 任务提取
     try:
         task_summary = extract_tasks_with_deepseek(input_query, categories_response)
@@ -92,252 +71,152 @@ def data_preprocess(input_query: str) -> Dict[str, Any]:
     except Exception as e:
         return {"error": f"Task extraction failed: {str(e)}"}
 
+def data_preprocess_batch(queries: List[str]) -> List[Dict[str, Any]]:
+    """
+    批量数据预处理函数，多个查询共用一次分类信息获取和一次LLM调用
+
+    Args:
+        queries (List[str]): 用户输入的查询问题列表
+
+    Returns:
+        List[Dict[str, Any]]: 与queries一一对应的任务摘要
+    """
+    if not queries:
+        return []
+
+    try:
+        categories_response = get_categories()
+        if not categories_response:
+            return [{"error": "Failed to fetch categories"} for _ in queries]
+    except Exception as e:
+        return [{"error": f"HTTP request failed: {str(e)}"} for _ in queries]
+
+    try:
+        return extract_tasks_batch(queries, categories_response)
+    except Exception as e:
+        return [{"error": f"Task extraction failed: {str(e)}"} for _ in queries]
+
 def get_categories() -> Optional[Dict[str, Any]]:
     """
     获取订单分类信息
-    
+
     Returns:
         Optional[Dict[str, Any]]: API响应数据
     """
-    url = "https://1m9r5sk109.execute-api.cn-northwest-1.amazonaws.com.cn/prod/category"
-    
+    categories = get_cached_categories()
+    if categories is not None:
+        return categories
+
     try:
-        response = requests.get(url, timeout=30)
+        response = _SESSION.get(CATEGORY_API_URL, timeout=30)
         response.raise_for_status()
-        print(response.json())
-        return response.json()
+        categories = orjson.loads(response.content)
     except requests.exceptions.RequestException as e:
         print(f"HTTP请求失败: {e}")
         return None
 
+    cache_categories(categories)
+    return categories
+
 def call_siliconflow_deepseek(messages: list, temperature: float = 0.7) -> Optional[str]:
     """
     调用硅基流动 DeepSeek API
-    
+
     Args:
         messages (list): 对话消息列表
         temperature (float): 温度参数，控制输出随机性
-        
+
     Returns:
-        Optional[str]: API响应内容
+        Optional[str]: API响应内容（流式接收，JSON结果完整后提前结束）
     """
-    
-    # 从环境变量获取API密钥
-    api_key = os.getenv('SILICONFLOW_API_KEY')
-    if not api_key:
-        raise ValueError("请设置环境变量 SILICONFLOW_API_KEY")
-    
-    url = "https://api.siliconflow.cn/v1/chat/completions"
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "model": "deepseek-ai/DeepSeek-V3",
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": 2000,
-        "stream": False
-    }
-    
+
+    headers = build_deepseek_headers()
+    payload = build_deepseek_payload(messages, temperature)
+
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        
-        result = response.json()
-        return result['choices'][0]['message']['content']
-        
+        content_parts = []
+        tracker = JsonCompletionTracker()
+        with _SESSION.post(
+            SILICONFLOW_CONFIG["api_url"],
+            headers=headers,
+            data=payload,
+            timeout=SILICONFLOW_CONFIG["timeout"],
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            # 按字节读取SSE行再按UTF-8解码，避免requests对text/event-stream误用latin-1解码
+            for line in response.iter_lines():
+                delta = parse_sse_line(line.decode("utf-8"))
+                if delta is None:
+                    break
+                if not delta:
+                    continue
+                content_parts.append(delta)
+                # 最外层JSON已经闭合，无需等待模型输出剩余内容
+                if tracker.feed(delta):
+                    break
+        return "".join(content_parts)
+
     except requests.exceptions.RequestException as e:
         print(f"DeepSeek API调用失败: {e}")
         return None
-    except (KeyError, IndexError) as e:
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
         print(f"解析API响应失败: {e}")
         return None
 
 def extract_tasks_with_deepseek(input_query: str, categories: Dict[str, Any]) -> Dict[str, Any]:
     """
     使用DeepSeek API从用户查询中提取订单任务信息
-    
+
     Args:
         input_query (str): 用户输入查询
         categories (Dict[str, Any]): 分类信息
-        
+
     Returns:
         Dict[str, Any]: 提取的任务信息
     """
-    
-    system_prompt = f"""你是一个订单查询分析助手。你需要从用户的查询问题中提取订单相关任务，并将其分解为标准格式。
-
-你需要遵循以下规则：
-1. 意图库是categories in {json.dumps(categories, ensure_ascii=False)}
-2. 每个task必须包含订单号(order_id)和具体意图(purpose)
-3. 判断是否为有效问题(valid_question)：查询内容必须与意图库中的操作相关
-4. 判断是否为多任务(multi-task)：包含多个订单号或多个意图时为true
-5. 统计任务数量(task_count)：提取出的合法task数量
-6. 按照固定格式输出结果，必须是有效的JSON格式
-
-输出格式示例：
-单任务：
-{{
-    "valid_question": "yes",
-    "multi-task": "no",
-    "task_count": 1,
-    "tasks": {{
-        "order_id_1": "xxx",
-        "purpose_1": "xxx"
-    }}
-}}
-
-多任务：
-{{
-    "valid_question": "yes",
-    "multi-task": "yes",
-    "task_count": 2,
-    "task_1": {{
-        "order_id_1": "xxx",
-        "purpose_1": "xxx"
-    }},
-    "task_2": {{
-        "order_id_2": "xxx",
-        "purpose_2": "xxx"
-    }}
-}}
-
-无效问题：
-{{
-    "valid_question": "no"
-}}"""
-
-    user_prompt = f"""请分析以下查询问题，提取订单任务信息：
-
-{input_query}
-
-请按照以下步骤进行分析，只输出最终的JSON结果：
-
-1. 判断是否为有效的订单相关问题
-2. 识别问题中的订单号和操作意图
-3. 确认是否存在多任务情况
-4. 统计任务数量
-5. 按照规定格式输出结果"""
-
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-    ]
-    
-    # 调用DeepSeek API
+
+    cached = get_cached_task_summary(input_query, categories)
+    if cached is not None:
+        return cached
+
+    messages = build_task_messages(input_query, categories)
+
+    # 调用DeepSeek API，失败或解析失败时使用备用方案
     response_content = call_siliconflow_deepseek(messages, temperature=0.7)
-    
-    if not response_content:
-        # 如果API调用失败，使用备用方案
-        return simulate_llm_response(input_query)
-    
-    try:
-        # 尝试解析JSON响应
-        # 清理响应内容，移除可能的markdown格式
-        cleaned_content = response_content.strip()
-        if cleaned_content.startswith('```json'):
-            cleaned_content = cleaned_content[7:]
-        if cleaned_content.endswith('```'):
-            cleaned_content = cleaned_content[:-3]
-        cleaned_content = cleaned_content.strip()
-        
-        result = json.loads(cleaned_content)
-        return result
-        
-    except json.JSONDecodeError as e:
-        print(f"JSON解析失败: {e}")
-        print(f"原始响应: {response_content}")
-        # 如果解析失败，使用备用方案
-        return simulate_llm_response(input_query)
-
-def simulate_llm_response(input_query: str) -> Dict[str, Any]:
+    return parse_task_response(response_content, input_query, categories)
+
+def extract_tasks_batch(queries: List[str], categories: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
-    模拟LLM响应（备用方案）
-    
+    在一次DeepSeek API调用中批量提取多个查询的订单任务信息，
+    意图库只在系统提示词中出现一次
+
     Args:
-        input_query (str): 用户查询
-        
+        queries (List[str]): 用户输入查询列表
+        categories (Dict[str, Any]): 分类信息
+
     Returns:
-        Dict[str, Any]: 模拟的任务提取结果
+        List[Dict[str, Any]]: 与queries一一对应的任务信息
     """
-    
-    # 简单的关键词匹配逻辑作为示例
-    import re
-    
-    # 查找订单号模式
-    order_patterns = [
-        r'订单号?\s*[：:]\s*([A-Za-z0-9]+)',
-        r'订单\s*([A-Za-z0-9]+)',
-        r'([A-Za-z0-9]{10,})'  # 假设订单号至少10位
-    ]
-    
-    order_ids = []
-    for pattern in order_patterns:
-        matches = re.findall(pattern, input_query)
-        order_ids.extend(matches)
-    
-    # 移除重复
-    order_ids = list(set(order_ids))
-    
-    if not order_ids:
-        return {"valid_question": "no"}
-    
-    # 简单的意图识别
-    purposes = []
-    if any(word in input_query for word in ['查询', '查看', '状态']):
-        purposes.append('查询订单状态')
-    if any(word in input_query for word in ['取消', '退订']):
-        purposes.append('取消订单')
-    if any(word in input_query for word in ['修改', '更改']):
-        purposes.append('修改订单')
-    
-    if not purposes:
-        purposes = ['查询订单状态']  # 默认意图
-    
-    task_count = max(len(order_ids), len(purposes))
-    
-    if task_count == 1:
-        return {
-            "valid_question": "yes",
-            "multi-task": "no",
-            "task_count": 1,
-            "tasks": {
-                "order_id_1": order_ids[0] if order_ids else "unknown",
-                "purpose_1": purposes[0]
-            }
-        }
-    else:
-        result = {
-            "valid_question": "yes",
-            "multi-task": "yes",
-            "task_count": task_count
-        }
-        
-        for i in range(task_count):
-            task_key = f"task_{i+1}"
-            result[task_key] = {
-                f"order_id_{i+1}": order_ids[i] if i < len(order_ids) else order_ids[-1],
-                f"purpose_{i+1}": purposes[i] if i < len(purposes) else purposes[-1]
-            }
-        
-        return result
+    if not queries:
+        return []
+
+    messages = build_batch_messages(queries, categories)
+    response_content = call_siliconflow_deepseek(messages, temperature=0.7)
+    return parse_batch_response(response_content, queries)
 
 # 使用示例
 if __name__ == "__main__":
     # 设置API密钥（实际使用时应该从环境变量获取）
     # os.environ['SILICONFLOW_API_KEY'] = 'your_api_key_here'
-    
+
     # 测试用例
     test_queries = [
         "我要调整订单ST-9012的配送时间",
         "今天天气怎么样？"  # 无效问题
     ]
-    
-    for query in test_queries:
+
+    for query, result in zip(test_queries, data_preprocess_batch(test_queries)):
         print(f"\n查询: {query}")
-        result = data_preprocess(query)
         print(f"结果: {json.dumps(result, ensure_ascii=False, indent=2)}")
         print("-" * 50)
@@ -1,6 +1,12 @@
-import requests
-import json
-from typing import Dict, Any, Optional
+import asyncio
+import httpx
+import orjson
+import hashlib
+import re
+import string
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator, Optional
 import logging
 import time
 import os
@@ -15,8 +21,78 @@ max_retries = 3
 retry_interval = 0.1  # 100ms
 timeout = 30
 
+# 未设置密钥时不在导入阶段报错，快速比较和备用逻辑不依赖密钥
+_API_KEY = os.getenv('SILICONFLOW_API_KEY')
+_HEADERS = {
+    "Authorization": f"Bearer {_API_KEY}",
+    "Content-Type": "application/json"
+} if _API_KEY else None
+
+# DeepSeek请求体中每次调用都不变的部分
+_PAYLOAD_BASE = {
+    "model": "deepseek-ai/DeepSeek-V3",
+    "max_tokens": 2000,
+    "stream": True
+}
+
+# 提示词规定的两种固定输出；流式接收时某一种已完整出现即可提前结束，
+# 不再等待结尾的引号和模型附加的说明
+ADDRESS_RESULTS = (
+    "待更改地址与原地址相同，无需更改",
+    "地址更新，将尝试拦截订单，并转人工客服处理"
+)
+
+# 地址比较提示词模板，模块加载时构建一次，每次调用只填入原地址数据和待更改地址
+SYSTEM_PROMPT = "你是一个地址检查助手"
+USER_PROMPT_TEMPLATE = """请提取{original_address}中的地址，并检查是否和{input_address}是指代相同的地址，
+
+输出的结果只包含下面两种情况，不要包括中间思考信息和其他任何内容
+
+如果相同，返回
+
+"待更改地址与原地址相同，无需更改"
+
+如果不同，返回
+
+"地址更新，将尝试拦截订单，并转人工客服处理"。
+
+"""
+
+# 地址比较结果缓存：相同的(原地址数据, 待更改地址)组合直接复用上次的LLM结果
+COMPARE_CACHE_TTL = 3600  # 1小时
+COMPARE_CACHE_MAX_ENTRIES = 1000
+_COMPARE_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+
+# 熔断器：连续失败达到阈值后，在冷却时间内直接走备用逻辑，不再等待超时
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_TIMEOUT = 30  # 秒
+# probe_started记录半开状态下探测请求的开始时间，同一时间只放行一个探测请求
+_LLM_BREAKER = {"failures": 0, "opened_at": None, "probe_started": None}
+_ADDRESS_API_BREAKER = {"failures": 0, "opened_at": None, "probe_started": None}
+
+# 共享异步HTTP客户端：复用keep-alive连接，单个事件循环即可并发处理多个工具调用
+# （连接池参数需传给transport，传入transport后AsyncClient自身的limits不再生效；
+# transport的retries只重试连接错误，网关返回的502/503/504在get_original_address中重试）
+_client = httpx.AsyncClient(
+    timeout=60,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=max_retries,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+)
+_RETRY_STATUSES = {502, 503, 504}
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """服务器退出时关闭共享HTTP客户端"""
+    try:
+        yield
+    finally:
+        await _client.aclose()
+
 # 创建MCP服务器实例
-mcp = FastMCP("kit-address-check")
+mcp = FastMCP("kit-address-check", lifespan=_lifespan)
 
 # 从环境变量获取API密钥
 def get_api_key():
@@ -27,7 +103,39 @@ def get_api_key():
         print("请运行: export SILICONFLOW_API_KEY='your_api_key_here'")
     return api_key
 
-def get_original_address(order_id: str) -> Dict[str, Any]:
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态时抛出"""
+
+def _breaker_allows(breaker: Dict[str, Any]) -> bool:
+    """
+    熔断器关闭时返回True；打开且冷却时间已过时只放行一个探测请求，其余调用继续走备用逻辑
+
+    探测请求若未记录结果（例如被取消），超过BREAKER_RESET_TIMEOUT后允许发起新的探测
+    """
+    opened_at = breaker["opened_at"]
+    if opened_at is None:
+        return True
+    now = time.monotonic()
+    if now - opened_at < BREAKER_RESET_TIMEOUT:
+        return False
+    probe_started = breaker["probe_started"]
+    if probe_started is not None and now - probe_started < BREAKER_RESET_TIMEOUT:
+        return False
+    breaker["probe_started"] = now
+    return True
+
+def _breaker_record(breaker: Dict[str, Any], success: bool) -> None:
+    """记录一次调用结果：成功则复位，连续失败达到阈值则打开熔断器"""
+    breaker["probe_started"] = None
+    if success:
+        breaker["failures"] = 0
+        breaker["opened_at"] = None
+        return
+    breaker["failures"] += 1
+    if breaker["failures"] >= BREAKER_FAIL_MAX:
+        breaker["opened_at"] = time.monotonic()
+
+async def get_original_address(order_id: str) -> Dict[str, Any]:
     """
     Get original address by order_id
         
@@ -38,30 +146,59 @@ def get_original_address(order_id: str) -> Dict[str, Any]:
         Dict containing the API response
     """
     params = {"order_id": order_id}
-        
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Getting original address for order_id: {order_id}, attempt: {attempt + 1}")
-            response = requests.get(
+
+    if not _breaker_allows(_ADDRESS_API_BREAKER):
+        raise CircuitOpenError("Address API circuit is open, skipping request")
+
+    logger.info(f"Getting original address for order_id: {order_id}")
+    try:
+        for attempt in range(max_retries + 1):
+            response = await _client.get(
                 address_check_url,
                 params=params,
-                timeout=30
+                timeout=timeout
             )
-                
-            return {
-                "status_code": response.status_code,
-                "body": response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text,
-                "headers": dict(response.headers),
-                "success": response.status_code == 200
-            }
-                
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Request failed on attempt {attempt + 1}: {str(e)}")
-            if attempt == self.max_retries - 1:
-                raise
-            time.sleep(self.retry_interval)
+            if response.status_code not in _RETRY_STATUSES or attempt == max_retries:
+                break
+            await asyncio.sleep(retry_interval * (2 ** attempt))
+    except httpx.HTTPError as e:
+        logger.warning(f"Request failed on attempt {attempt + 1}: {type(e).__name__}: {str(e)}")
+        _breaker_record(_ADDRESS_API_BREAKER, success=False)
+        raise
+    _breaker_record(_ADDRESS_API_BREAKER, success=response.status_code < 500)
+
+    return {
+        "status_code": response.status_code,
+        "body": orjson.loads(response.content) if response.headers.get('content-type', '').startswith('application/json') else response.text,
+        "headers": dict(response.headers),
+        "success": response.status_code == 200
+    }
     
-def compare_addresses_with_llm(original_address_data: Any, input_address: str) -> str:
+def _compare_cache_key(original_address_data: Any, input_address: str) -> str:
+    """根据原地址数据和待更改地址生成缓存键"""
+    raw = orjson.dumps({"orig": original_address_data, "input": input_address}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+def _get_cached_comparison(key: str) -> Optional[Any]:
+    """返回未过期的缓存比较结果，未命中时返回None"""
+    entry = _COMPARE_CACHE.get(key)
+    if entry is None:
+        return None
+    ts, result = entry
+    if time.monotonic() - ts >= COMPARE_CACHE_TTL:
+        del _COMPARE_CACHE[key]
+        return None
+    _COMPARE_CACHE.move_to_end(key)
+    return result
+
+def _cache_comparison(key: str, result: Any) -> None:
+    """写入比较结果，超过容量时淘汰最久未使用的条目"""
+    _COMPARE_CACHE[key] = (time.monotonic(), result)
+    _COMPARE_CACHE.move_to_end(key)
+    while len(_COMPARE_CACHE) > COMPARE_CACHE_MAX_ENTRIES:
+        _COMPARE_CACHE.popitem(last=False)
+
+async def compare_addresses_with_llm(original_address_data: Any, input_address: str) -> str:
     """
     Compare addresses using LLM (simulated)
     In a real implementation, this would call DeepSeek-V3 via SiliconFlow
@@ -73,20 +210,23 @@ def compare_addresses_with_llm(original_address_data: Any, input_address: str) -
     Returns:
         Comparison result string
     """
-    system_prompt = "你是一个地址检查助手"
-    user_prompt = f"""请提取{json.dumps(original_address_data)}中的地址，并检查是否和{input_address}是指代相同的地址，
+    # 完全相同或省份不同的地址无需调用LLM
+    quick_result = _quick_compare_addresses(original_address_data, input_address)
+    if quick_result is not None:
+        logger.info("Address comparison resolved without LLM")
+        return quick_result
 
-输出的结果只包含下面两种情况，不要包括中间思考信息和其他任何内容
-
-如果相同，返回
-
-"待更改地址与原地址相同，无需更改"
+    cache_key = _compare_cache_key(original_address_data, input_address)
+    cached = _get_cached_comparison(cache_key)
+    if cached is not None:
+        logger.info("Address comparison cache hit")
+        return cached
 
-如果不同，返回
-
-"地址更新，将尝试拦截订单，并转人工客服处理"。
-
-"""
+    system_prompt = SYSTEM_PROMPT
+    user_prompt = USER_PROMPT_TEMPLATE.format(
+        original_address=orjson.dumps(original_address_data).decode(),
+        input_address=input_address
+    )
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
@@ -97,7 +237,7 @@ def compare_addresses_with_llm(original_address_data: Any, input_address: str) -
     logger.info(f"User prompt: {user_prompt}")
         
     # 调用DeepSeek API
-    response_content = call_siliconflow_deepseek(messages, temperature=0.7)
+    response_content = await call_siliconflow_deepseek(messages, temperature=0.7, fixed_outputs=ADDRESS_RESULTS)
     
     if not response_content:
         # 如果API调用失败，使用备用方案
@@ -110,6 +250,9 @@ def compare_addresses_with_llm(original_address_data: Any, input_address: str) -
                 return "待更改地址与原地址相同，无需更改"
             else:
                 return "地址更新，将尝试拦截订单，并转人工客服处理"
+    elif response_content in ADDRESS_RESULTS:
+        _cache_comparison(cache_key, response_content)
+        return response_content
     else:
         cleaned_content = response_content.strip()
         if cleaned_content.startswith('```json'):
@@ -118,53 +261,82 @@ def compare_addresses_with_llm(original_address_data: Any, input_address: str) -
             cleaned_content = cleaned_content[:-3]
         cleaned_content = cleaned_content.strip()
         
-        result = json.loads(cleaned_content)
+        result = orjson.loads(cleaned_content)
+        _cache_comparison(cache_key, result)
         return result
     return "地址更新，将尝试拦截订单，并转人工客服处理"
 
-def call_siliconflow_deepseek(messages: list, temperature: float = 0.7) -> Optional[str]:
+def _parse_sse_line(line: str) -> Optional[str]:
+    """解析一行SSE流式响应，返回本行新增的内容；收到结束标记时返回None"""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    choices = orjson.loads(data).get('choices')
+    if not choices:
+        return ""
+    return choices[0]['delta'].get('content') or ""
+
+def _match_fixed_output(text: str, fixed_outputs: tuple) -> Optional[str]:
+    """累计内容（去掉开头的代码块标记和引号后）已完整包含某个固定输出时返回该输出"""
+    cleaned = text.lstrip()
+    if cleaned.startswith('```'):
+        cleaned = cleaned[3:].removeprefix('json')
+    cleaned = cleaned.lstrip().lstrip('"“')
+    for output in fixed_outputs:
+        if cleaned.startswith(output):
+            return output
+    return None
+
+async def call_siliconflow_deepseek(messages: list, temperature: float = 0.7, fixed_outputs: tuple = ()) -> Optional[str]:
     """
     调用硅基流动 DeepSeek API
     
     Args:
         messages (list): 对话消息列表
         temperature (float): 温度参数，控制输出随机性
+        fixed_outputs (tuple): 可能的固定输出，流式内容已完整出现其中之一时立即返回该输出并关闭连接
         
     Returns:
         Optional[str]: API响应内容
     """
     
-    # 从环境变量获取API密钥
-    api_key = os.getenv('SILICONFLOW_API_KEY')
-    if not api_key:
+    if _HEADERS is None:
         raise ValueError("请设置环境变量 SILICONFLOW_API_KEY")
     
     url = "https://api.siliconflow.cn/v1/chat/completions"
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "model": "deepseek-ai/DeepSeek-V3",
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": 2000,
-        "stream": False
-    }
+    payload = orjson.dumps({**_PAYLOAD_BASE, "messages": messages, "temperature": temperature})
     
+    if not _breaker_allows(_LLM_BREAKER):
+        logger.warning("DeepSeek API熔断中，直接使用备用方案")
+        return None
+
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        
-        result = response.json()
-        return result['choices'][0]['message']['content']
+        content_parts = []
+        async with _client.stream("POST", url, headers=_HEADERS, content=payload, timeout=60) as response:
+            response.raise_for_status()
+            _breaker_record(_LLM_BREAKER, success=True)
+
+            async for line in response.aiter_lines():
+                delta = _parse_sse_line(line)
+                if delta is None:
+                    break
+                if not delta:
+                    continue
+                content_parts.append(delta)
+                # 固定输出已完整出现，退出时关闭连接，不再等待模型生成剩余内容
+                matched = _match_fixed_output("".join(content_parts), fixed_outputs)
+                if matched is not None:
+                    return matched
+        return "".join(content_parts)
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        _breaker_record(_LLM_BREAKER, success=False)
         print(f"DeepSeek API调用失败: {e}")
         return None
-    except (KeyError, IndexError) as e:
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
         print(f"解析API响应失败: {e}")
         return None
         
@@ -178,7 +350,7 @@ def _extract_address_from_data(data: Dict[str, Any]) -> str:
             return str(data[field])
         
     # If no specific address field found, return the whole data as string
-    return json.dumps(data, ensure_ascii=False)
+    return orjson.dumps(data).decode()
     
 def _addresses_are_similar(addr1: str, addr2: str) -> bool:
     """Simple address similarity check"""
@@ -188,9 +360,47 @@ def _addresses_are_similar(addr1: str, addr2: str) -> bool:
         
     # Simple similarity check - in real implementation, use more sophisticated logic
     return addr1_clean == addr2_clean or addr1_clean in addr2_clean or addr2_clean in addr1_clean
+
+# 地址归一化：全角字符转半角，去掉空白，英文转小写；
+# 标点保留不动，"3-101室"和"31-01室"这类靠分隔符区分的门牌号不能被合并
+_ADDRESS_TRANSLATION = {code: code - 0xFEE0 for code in range(0xFF01, 0xFF5F)}
+_ADDRESS_TRANSLATION.update({ord(ch): None for ch in string.whitespace + "\u3000"})
+
+# 带行政区划后缀的省级行政区前缀（如"上海市"、"西藏自治区"），两个地址的省份不同即可判定为不同地址；
+# 必须带后缀，否则"西藏中路"、"山西路"这类以省名命名的道路会被误判为省份
+_PROVINCE_RE = re.compile(
+    r'^(北京|天津|上海|重庆|河北|山西|辽宁|吉林|黑龙江|江苏|浙江|安徽|福建|江西|山东|河南|湖北|湖南|'
+    r'广东|海南|四川|贵州|云南|陕西|甘肃|青海|台湾|内蒙古|广西|西藏|宁夏|新疆|香港|澳门)'
+    r'(?:省|市|(?:壮族|回族|维吾尔)?自治区|特别行政区)'
+)
+
+def _normalize_address(addr: str) -> str:
+    """归一化地址字符串，用于不调用LLM的快速比较"""
+    return addr.translate(_ADDRESS_TRANSLATION).lower()
+
+def _quick_compare_addresses(original_address_data: Any, input_address: str) -> Optional[str]:
+    """
+    不调用LLM的快速地址比较：归一化后完全相同，或两者都以带后缀的省级行政区开头且省份不同时直接给出结果
+
+    Returns:
+        Optional[str]: 可以直接判定时返回比较结果，否则返回None交给LLM判断
+    """
+    if not isinstance(original_address_data, dict):
+        return None
+
+    original = _normalize_address(_extract_address_from_data(original_address_data))
+    candidate = _normalize_address(input_address)
+    if original == candidate:
+        return "待更改地址与原地址相同，无需更改"
+
+    original_province = _PROVINCE_RE.match(original)
+    candidate_province = _PROVINCE_RE.match(candidate)
+    if original_province and candidate_province and original_province.group(1) != candidate_province.group(1):
+        return "地址更新，将尝试拦截订单，并转人工客服处理"
+    return None
     
 @mcp.tool()    
-def check_address(order_id: str, input_address: str) -> Dict[str, Any]:
+async def check_address(order_id: str, input_address: str, ctx: Context = None) -> Dict[str, Any]:
     """
     Main method to check address difference
     Implements the complete workflow from kit_address_check.yml
@@ -198,6 +408,7 @@ def check_address(order_id: str, input_address: str) -> Dict[str, Any]:
     Args:
         order_id (str): The order ID to query
         input_address (str): The new address to compare
+        ctx: MCP context injected by FastMCP, used to report progress between the two steps
             
     Returns:
         Dict containing the comparison result
@@ -205,7 +416,9 @@ def check_address(order_id: str, input_address: str) -> Dict[str, Any]:
     try:
         # Step 1: Get original address from API
         logger.info(f"Starting address check for order_id: {order_id}, input_address: {input_address}")
-        address_response = get_original_address(order_id)
+        if ctx is not None:
+            await ctx.report_progress(0, 2)
+        address_response = await get_original_address(order_id)
             
         if not address_response["success"]:
             return {
@@ -216,10 +429,14 @@ def check_address(order_id: str, input_address: str) -> Dict[str, Any]:
             }
             
         # Step 2: Compare addresses using LLM
-        comparison_result = compare_addresses_with_llm(
+        if ctx is not None:
+            await ctx.report_progress(1, 2)
+        comparison_result = await compare_addresses_with_llm(
             address_response["body"],
             input_address
         )
+        if ctx is not None:
+            await ctx.report_progress(2, 2)
         
         return comparison_result
             
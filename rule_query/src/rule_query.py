@@ -1,7 +1,13 @@
-import requests
-import json
-from typing import Dict, Any, Optional
+import asyncio
+import httpx
+import orjson
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator, List, Optional
 import os
+import random
+import re
+import time
 import sys
 import logging
 from mcp.server.fastmcp import FastMCP, Context
@@ -18,7 +24,15 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-mcp = FastMCP("rule-query-server")
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """服务器退出时关闭共享HTTP客户端"""
+    try:
+        yield
+    finally:
+        await _client.aclose()
+
+mcp = FastMCP("rule-query-server", lifespan=_lifespan)
 
 # 硅基流动 API 配置
 SILICONFLOW_CONFIG = {
@@ -31,6 +45,52 @@ SILICONFLOW_CONFIG = {
 ORDER_STATUS_URL = "https://1m9r5sk109.execute-api.cn-northwest-1.amazonaws.com.cn/prod/kit_box/order_status"
 PURPOSE_URL = "https://1m9r5sk109.execute-api.cn-northwest-1.amazonaws.com.cn/prod/purpose"
 
+# 规则过滤提示词，模块加载时构建一次，每次调用只填入规则和订单状态数据
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "you are an rule filter, your task is to filter rule based on input status"
+}
+USER_PROMPT_TEMPLATE = """rule definition is in {rule_data}, filter condition is in {order_status_data}
+
+please just output matched rule, do not include purpose and status, expected format as below
+
+{{"规则": {{rule_detail}}}}"""
+
+# 去掉LLM输出中可能包裹的markdown代码块标记（开头或结尾缺失时同样适用）
+_FENCE_RE = re.compile(r'^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$', re.S)
+
+# 规则缓存：规则很少变化，同一purpose的成功响应在TTL内直接复用
+RULE_CACHE_TTL = 60  # 秒
+RULE_CACHE_MAX_ENTRIES = 256
+_RULE_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+# 每个purpose一把锁，缓存未命中时只有一个请求真正访问规则接口；
+# 同时记录持有或等待该锁的请求数，归零时删除锁，避免字典随purpose种类无限增长
+_RULE_LOCKS: "defaultdict[str, asyncio.Lock]" = defaultdict(asyncio.Lock)
+_RULE_LOCK_USERS: "defaultdict[str, int]" = defaultdict(int)
+
+# 请求头在导入时构建一次
+_API_KEY = os.getenv('SILICONFLOW_API_KEY')
+_LLM_HEADERS = {
+    "Authorization": f"Bearer {_API_KEY}",
+    "Content-Type": "application/json"
+} if _API_KEY else None
+
+# 共享异步HTTP客户端（HTTP/2多路复用；transport的retries只重试连接错误）
+_client = httpx.AsyncClient(
+    timeout=30,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30)
+    )
+)
+
+# 服务端错误的重试策略：指数退避，优先遵循Retry-After响应头
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_MAX_BACKOFF = 10  # 秒，重试等待上限
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
 # 从环境变量获取API密钥
 def get_api_key():
     """获取硅基流动API密钥"""
@@ -41,7 +101,39 @@ def get_api_key():
     return api_key
 
 
-def get_order_status(order_id: str) -> Dict[str, Any]:
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """重试等待时间：优先取Retry-After响应头，否则按指数退避并加随机抖动，上限RETRY_MAX_BACKOFF秒"""
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        delay = int(retry_after)
+    else:
+        delay = RETRY_BACKOFF_FACTOR * (2 ** attempt) * random.uniform(0.5, 1.5)
+    return min(delay, RETRY_MAX_BACKOFF)
+
+async def _get_with_retry(url: str, params: Dict[str, str]) -> httpx.Response:
+    """发送GET请求，遇到5xx状态码时重试（连接错误由transport重试）"""
+    for attempt in range(RETRY_TOTAL + 1):
+        response = await _client.get(url, params=params)
+        if response.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+            return response
+        await asyncio.sleep(_retry_delay(response, attempt))
+    return response
+
+async def _get_json(url: str, params: Dict[str, str]) -> Dict[str, Any]:
+    """
+    查询接口的公共实现：发送GET请求并整理为统一的响应字典，JSON响应体直接解析
+
+    Returns:
+        Dict containing status_code, body and headers
+    """
+    response = await _get_with_retry(url, params)
+    return {
+        "status_code": response.status_code,
+        "body": orjson.loads(response.content) if response.headers.get('content-type', '').startswith('application/json') else response.text,
+        "headers": dict(response.headers)
+    }
+
+async def get_order_status(order_id: str) -> Dict[str, Any]:
     """
     Get order status by order_id
 
@@ -51,30 +143,31 @@ def get_order_status(order_id: str) -> Dict[str, Any]:
     Returns:
         Dict containing the API response
     """
-    params = {"order_id": order_id}
-        
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                ORDER_STATUS_URL,
-                params=params,
-                timeout=30
-            )
-            
-            return {
-                "status_code": response.status_code,
-                "body": response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text,
-                "headers": dict(response.headers)
-            }
-                
-        except requests.exceptions.RequestException as e:
-            if attempt == 2:
-                raise
-            time.sleep(0.1)
+    return await _get_json(ORDER_STATUS_URL, {"order_id": order_id})
+
+def _get_cached_rule(purpose: str) -> Optional[Dict[str, Any]]:
+    """返回未过期的缓存规则响应，未命中时返回None"""
+    entry = _RULE_CACHE.get(purpose)
+    if entry is None:
+        return None
+    ts, result = entry
+    if time.monotonic() - ts >= RULE_CACHE_TTL:
+        del _RULE_CACHE[purpose]
+        return None
+    _RULE_CACHE.move_to_end(purpose)
+    return result
+
+def _cache_rule(purpose: str, result: Dict[str, Any]) -> None:
+    """写入规则响应，超过容量时淘汰最久未使用的条目"""
+    _RULE_CACHE[purpose] = (time.monotonic(), result)
+    _RULE_CACHE.move_to_end(purpose)
+    while len(_RULE_CACHE) > RULE_CACHE_MAX_ENTRIES:
+        _RULE_CACHE.popitem(last=False)
 
-def get_matched_rule(purpose: str) -> Dict[str, Any]:
+async def get_matched_rule(purpose: str) -> Dict[str, Any]:
     """
     Get matched rule by purpose
+    Successful responses are cached per purpose for RULE_CACHE_TTL seconds
         
     Args:
         purpose (str): The purpose to query rules for
@@ -82,32 +175,32 @@ def get_matched_rule(purpose: str) -> Dict[str, Any]:
     Returns:
         Dict containing the API response
     """
-    params = {"purpose": purpose}
-    for attempt in range(3):
-        try:
-            response = requests.get(
-                PURPOSE_URL,
-                params=params,
-                timeout=30
-        )
-                
-            return {
-                "status_code": response.status_code,
-                "body": response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text,
-                "headers": dict(response.headers)
-            }
-                
-        except requests.exceptions.RequestException as e:
-            if attempt == 2:
-                raise
-            time.sleep(0.1)
+    cached = _get_cached_rule(purpose)
+    if cached is not None:
+        return cached
 
+    _RULE_LOCK_USERS[purpose] += 1
+    try:
+        async with _RULE_LOCKS[purpose]:
+            # 等锁期间其他请求可能已经写入缓存
+            cached = _get_cached_rule(purpose)
+            if cached is not None:
+                return cached
 
-@mcp.tool()
-def query_rule(order_id: str, purpose: str) -> Dict[str, Any]:
+            result = await _get_json(PURPOSE_URL, {"purpose": purpose})
+            if result["status_code"] == 200:
+                _cache_rule(purpose, result)
+            return result
+    finally:
+        _RULE_LOCK_USERS[purpose] -= 1
+        if not _RULE_LOCK_USERS[purpose]:
+            del _RULE_LOCK_USERS[purpose]
+            del _RULE_LOCKS[purpose]
+
+
+async def _query_rule(order_id: str, purpose: str) -> Dict[str, Any]:
     """
-    Main method to query matched rule based on order_id and purpose
-    Implements the complete workflow from rule_query.yml
+    Implements the complete workflow from rule_query.yml, shared by query_rule and query_rule_batch
         
     Args:
         order_id (str): The order ID to query
@@ -116,24 +209,29 @@ def query_rule(order_id: str, purpose: str) -> Dict[str, Any]:
     Returns:
         Dict containing the final result
     """
+    # 规则查询只依赖purpose，与订单状态查询同时发出；订单不存在时取消
+    rule_task = asyncio.create_task(get_matched_rule(purpose))
+    # 订单查询失败时rule_task可能不会再被await，这里取走其异常，避免"exception was never retrieved"警告
+    rule_task.add_done_callback(lambda t: t.cancelled() or t.exception())
     try:
         # Step 1: Get order status
-        order_status_response = get_order_status(order_id)
+        order_status_response = await get_order_status(order_id)
         # Step 2: Check if order exists (status code = 200)
         if order_status_response["status_code"] == 200:
             # Step 3: Get matched rule
-            rule_response = get_matched_rule(purpose)
-            # Step 4: Filter rule using LLM
-            filtered_rule = filter_rule_with_llm(
+            rule_response = await rule_task
+            # Step 4: Filter rule using LLM（通过共享的异步客户端调用，不阻塞事件循环）
+            filtered_rule = await filter_rule_with_llm(
                 rule_response["body"], 
                 order_status_response["body"]
             )
 
-            print(filtered_rule)
+            logger.info("规则过滤结果: %s", filtered_rule)
 
             return filtered_rule
         else:
             # Order doesn't exist
+            rule_task.cancel()
             return {
                 "success": False,
                 "result": "order_id is not exist, please check",
@@ -141,59 +239,126 @@ def query_rule(order_id: str, purpose: str) -> Dict[str, Any]:
             }
                 
     except Exception as e:
+        rule_task.cancel()
         return {
             "success": False,
             "error": str(e),
             "result": "An error occurred while processing the request"
         }
 
-def call_siliconflow_deepseek(messages: list, temperature: float = 0.7) -> Optional[str]:
+@mcp.tool()
+async def query_rule(order_id: str, purpose: str) -> str:
     """
-    调用硅基流动 DeepSeek API
+    Main method to query matched rule based on order_id and purpose
+        
+    Args:
+        order_id (str): The order ID to query
+        purpose (str): The purpose for rule matching
+            
+    Returns:
+        str: JSON formatted final result
+    """
+    return orjson.dumps(await _query_rule(order_id, purpose)).decode()
+
+@mcp.tool()
+async def query_rule_batch(queries: List[Dict[str, str]]) -> str:
+    """
+    Batch version of query_rule: run several (order_id, purpose) queries concurrently in one tool call
+    Repeated purposes share one rule lookup through the rule cache
+
+    Args:
+        queries (List[Dict[str, str]]): Items like {"order_id": "CD-5678", "purpose": "取消订单"}
+
+    Returns:
+        str: JSON array of query_rule results, in the same order as queries
+    """
+    async def run_query(query: Dict[str, str]) -> Any:
+        # 在协程内取参数，缺少字段时只影响这一条查询
+        return await _query_rule(query["order_id"], query["purpose"])
+
+    results = await asyncio.gather(
+        *(run_query(query) for query in queries),
+        return_exceptions=True
+    )
+    return orjson.dumps([
+        {
+            "success": False,
+            "error": str(result),
+            "result": "An error occurred while processing the request"
+        } if isinstance(result, BaseException) else result
+        for result in results
+    ]).decode()
+
+async def stream_siliconflow_deepseek(messages: list, temperature: float = 0.7) -> AsyncIterator[str]:
+    """
+    以SSE流式方式调用硅基流动 DeepSeek API，逐段产出模型生成的内容
     
     Args:
         messages (list): 对话消息列表
         temperature (float): 温度参数，控制输出随机性
         
-    Returns:
-        Optional[str]: API响应内容
+    Yields:
+        str: 本次新增的响应内容
     """
     
-    # 从环境变量获取API密钥
-    api_key = os.getenv('SILICONFLOW_API_KEY')
-    if not api_key:
+    if _LLM_HEADERS is None:
         raise ValueError("请设置环境变量 SILICONFLOW_API_KEY")
     
     url = "https://api.siliconflow.cn/v1/chat/completions"
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
         "model": "deepseek-ai/DeepSeek-V3",
         "messages": messages,
         "temperature": temperature,
         "max_tokens": 2000,
-        "stream": False
+        "stream": True
     }
     
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
+    content = orjson.dumps(payload)
+    for attempt in range(RETRY_TOTAL + 1):
+        async with _client.stream("POST", url, headers=_LLM_HEADERS, content=content, timeout=60) as response:
+            # 还未产出任何内容，遇到5xx时可以按与GET相同的策略安全重试
+            if response.status_code in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                delay = _retry_delay(response, attempt)
+            else:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = orjson.loads(data).get('choices')
+                    if choices:
+                        delta = choices[0]['delta'].get('content')
+                        if delta:
+                            yield delta
+                return
+        await asyncio.sleep(delay)
+
+async def call_siliconflow_deepseek(messages: list, temperature: float = 0.7) -> Optional[str]:
+    """
+    调用硅基流动 DeepSeek API
+    
+    Args:
+        messages (list): 对话消息列表
+        temperature (float): 温度参数，控制输出随机性
         
-        result = response.json()
-        return result['choices'][0]['message']['content']
+    Returns:
+        Optional[str]: API响应内容（流式接收后拼接）
+    """
+    
+    try:
+        return "".join([delta async for delta in stream_siliconflow_deepseek(messages, temperature)])
         
-    except requests.exceptions.RequestException as e:
-        print(f"DeepSeek API调用失败: {e}")
+    except httpx.HTTPError as e:
+        logger.error("DeepSeek API调用失败: %s", e)
         return None
-    except (KeyError, IndexError) as e:
-        print(f"解析API响应失败: {e}")
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+        logger.error("解析API响应失败: %s", e)
         return None
 
-def filter_rule_with_llm(rule_data: Any, order_status_data: Any) -> str:
+async def filter_rule_with_llm(rule_data: Any, order_status_data: Any) -> Dict[str, Any]:
     """
     Simulate LLM filtering of rules based on order status
     In a real implementation, this would call an actual LLM service
@@ -203,24 +368,22 @@ def filter_rule_with_llm(rule_data: Any, order_status_data: Any) -> str:
         order_status_data: Order status data for filtering
             
     Returns:
-        Filtered rule in JSON format
+        Filtered rule parsed from the LLM output, encoded to JSON once by the calling tool
     """
     # This is a simplified simulation of the LLM processing
     # In the actual workflow, this would call DeepSeek-V3 via SiliconFlow
         
-    system_prompt = "you are an rule filter, your task is to filter rule based on input status"
-    user_prompt = f"""rule definition is in {json.dumps(rule_data)}, filter condition is in {json.dumps(order_status_data)}
-
-please just output matched rule, do not include purpose and status, expected format as below
-
-{{"规则": {{rule_detail}}}}"""
+    user_prompt = USER_PROMPT_TEMPLATE.format(
+        rule_data=orjson.dumps(rule_data).decode(),
+        order_status_data=orjson.dumps(order_status_data).decode()
+    )
         
     messages = [
-        {"role": "system", "content": system_prompt},
+        _SYSTEM_MESSAGE,
         {"role": "user", "content": user_prompt}
     ]
 
-    response_content = call_siliconflow_deepseek(messages, temperature=0.7)
+    response_content = await call_siliconflow_deepseek(messages, temperature=0.7)
 
     # Simplified rule matching logic (replace with actual LLM call)
     #if isinstance(rule_data, dict) and isinstance(order_status_data, dict):
@@ -232,12 +395,24 @@ please just output matched rule, do not include purpose and status, expected for
     #            "filter_condition": order_status_data
     #        }
     #    }
-    return json.dumps(response_content, ensure_ascii=False, indent=2)    
+    if response_content is None:
+        return {
+            "success": False,
+            "error": "LLM rule filtering failed",
+            "result": "An error occurred while processing the request"
+        }
+
+    cleaned_content = _FENCE_RE.match(response_content).group(1)
+    try:
+        return orjson.loads(cleaned_content)
+    except orjson.JSONDecodeError:
+        # 模型没有按JSON格式输出时保留原文
+        return {"规则": cleaned_content}
     
 
 if __name__ == "__main__":
     try:
         mcp.run()
     except Exception as e:
-        logger.error(f"服务器运行异常: {str(e)}")
+        logger.error("服务器运行异常: %s", e)
         raise
\ No newline at end of file